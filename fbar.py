@@ -1,35 +1,272 @@
 # project.py
 # Carolina Lovato
 
-import requests
-import tabulate
+# annotations stay as text, so BankBook can name np.ndarray without importing numpy
+from __future__ import annotations
+
+import datetime
+import functools
+import json
+import os
 import sys
 import re
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from math import fsum
+from operator import itemgetter
+from typing import List
 
+# orjson parses the API responses faster, the standard json module is used when it is not installed
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
 
-# Get exchange rate from Treasury website API
-def get_exchange_rate(country_name, currency_name, year):
+
+# Treasury API address
+API_URL = "https://api.fiscaldata.treasury.gov/services/api/fiscal_service/v1/accounting/od/rates_of_exchange"
+
+# total balance in US dollars from which an FBAR form may be needed
+FBAR_THRESHOLD = 10000
+# messages printed at the end of the report, formatted with the threshold and the filing year
+#  0: total balance is below FBAR_THRESHOLD
+#  1: total balance is at or above FBAR_THRESHOLD
+_FBAR_MESSAGES = (
+    "As it does not exceed {threshold} you may not need to file a FBAR form on April of {next_year}.",
+    "As it exceeds {threshold} you MAY NEED to file an FBAR form on April of {next_year}.\n"
+    "Please go to https://bsaefiling.fincen.treas.gov/NoRegFBARFiler.html and type all asset values there for online FBAR filing.",
+)
+_THRESHOLD_STR = f"US${FBAR_THRESHOLD:,.0f}"
+
+# only accepts four-digits year
+_YEAR_RE = re.compile(r"\A\d{4}\Z")
+
+# one session for the whole process, so the TCP/TLS connection to Treasury
+# is reused between calls instead of being opened again every time
+# it is only created by _get_session, so importing fbar does not load requests
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+# file where exchange rates are kept between runs
+CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "fbar", "rates.json")
+# rates for the current year may still change, so they expire after one day
+CURRENT_YEAR_TTL = 24 * 60 * 60
+# only one thread at a time may rewrite the cache file
+_CACHE_LOCK = threading.Lock()
+
+
+# reads the whole cache file, returns an empty cache if it is missing or broken
+# load it once and look up every year with _cached_rate
+def _load_cache():
+    try:
+        with open(CACHE_FILE) as file:
+            cache = json.load(file)
+        if isinstance(cache, dict):
+            return cache
+    except (OSError, ValueError):
+        pass
+    return {}
+
+
+# gets a rate from a loaded cache, returns None if missing or expired
+def _cached_rate(cache, key, year):
+    try:
+        entry = cache[key]
+        # rates for past years are final and never expire
+        if int(year) < datetime.datetime.now().year:
+            return entry["rate"]
+        if time.time() - entry["fetched"] < CURRENT_YEAR_TTL:
+            return entry["rate"]
+    except (ValueError, KeyError, TypeError):
+        # no entry for this key or a broken entry
+        pass
+    return None
+
+
+# writes many rates to the cache file at once, rates is a dict from key to rate
+# a cache that cannot be written is just ignored
+def _save_rates(rates):
     try:
-        # API address
-        url = "https://api.fiscaldata.treasury.gov/services/api/fiscal_service/v1/accounting/od/rates_of_exchange"
-        # aditional parameters for the API
-        params = {
-            "format": "json",
-            "fields": "exchange_rate,record_date",
-            "filter": f"country_currency_desc:in:(USA-Dollar,{country_name}-{currency_name}),record_date:eq:{year}-12-31"
-        }
-        # uses the requests library to get something from the API
-        response = requests.get(url, params=params)
-        # from response, gets the json, extracts first element of data, then extracts exchange_rate
-        _usd_rate = float(response.json().get('data')[0].get('exchange_rate'))
-    except IndexError:
+        with _CACHE_LOCK:
+            # other calls may have written the file since it was loaded, so it is read again here
+            cache = _load_cache()
+            fetched = time.time()
+            for key, rate in rates.items():
+                cache[key] = {"rate": rate, "fetched": fetched}
+            os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+            # writes to a temporary file first so a crash never leaves half a file behind
+            temp_file = CACHE_FILE + ".tmp"
+            with open(temp_file, "w") as file:
+                json.dump(cache, file)
+            os.replace(temp_file, CACHE_FILE)
+    except OSError:
+        pass
+
+
+# returns the shared session, creating it on first use
+def _get_session():
+    global _SESSION
+    # get_exchange_rates_bulk may call this from several threads at once
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=10,
+                # flaky answers from Treasury are retried with a growing wait instead of stopping the program
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.3,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods={"GET"},
+                ),
+            ))
+            # requests decompresses gzip and deflate answers by itself
+            session.headers.update({"Accept": "text/csv, application/json", "Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+            _SESSION = session
+    return _SESSION
+
+
+# reads the exchange rates from an API response
+# returns a dict from year to exchange rate
+# the API is asked for csv, but a json answer is still understood
+def _parse_exchange_rates(response):
+    text = response.text.strip()
+    if text.startswith("{"):
+        # from the json, gets every element of data with its exchange_rate and record_date
+        records = [(item.get('exchange_rate'), item.get('record_date')) for item in _json_loads(response.content).get('data')]
+    else:
+        # line 0 is the header, every other line is exchange_rate,record_date
+        records = [line.replace('"', '').split(",") for line in text.splitlines()[1:]]
+    # record_date is like 2021-12-31, so the year is its first 4 characters
+    return {record_date[:4]: float(exchange_rate) for exchange_rate, record_date in records}
+
+
+# aditional parameters for the API to get the Dec 31st rates of one country and currency for many years
+def _rate_params(country_name, currency_name, years):
+    dates = ",".join(f"{year}-12-31" for year in years)
+    return {
+        "format": "csv",
+        "fields": "exchange_rate,record_date",
+        "sort": "-record_date",
+        "page[size]": len(years),
+        "filter": f"country_currency_desc:eq:{country_name}-{currency_name},record_date:in:({dates})"
+    }
+
+
+# splits queries of (country_name, currency_name, year) into the rates already in CACHE_FILE and the queries still missing
+# returns a dict from query to rate and a list of missing queries
+def _split_cached(queries):
+    # reads the cache file only once for all queries
+    cache = _load_cache()
+    rates = {}
+    missing = []
+    for query in queries:
+        rate = _cached_rate(cache, "|".join(query), query[2])
+        if rate is None:
+            missing.append(query)
+        else:
+            rates[query] = rate
+    return rates, missing
+
+
+# prints why the exchange rates could not be found and exits
+# a KeyError means Treasury answered without a rate for some year
+def _lookup_failed(error):
+    if isinstance(error, KeyError):
         print("\nUnfortunatelly this call to Treasury system returned no data. Tipically what happens is that this combination of Country and Currency is not supported for the year you requested.")
-        sys.exit(1)
-    except Exception as e:
-        # prints a message and exits when anything goes wrong with trying to use the API
+    else:
+        # anything else went wrong with trying to use the API
         print("\nSomething went wrong with your request, please check input values and try again")
-        sys.exit(1)
-    return _usd_rate
+    sys.exit(1)
+
+
+# Get exchange rates for many years of one country and currency from Treasury website API
+# years missing from CACHE_FILE are requested all together in a single call
+# returns a dict from year to exchange rate
+def get_exchange_rates(country_name, currency_name, years):
+    # tries the cache file before going to the network
+    rates, missing = _split_cached([(country_name, currency_name, year) for year in years])
+    if missing:
+        try:
+            # uses the shared session to get something from the API
+            response = _get_session().get(API_URL, params=_rate_params(country_name, currency_name, [year for _, _, year in missing]), timeout=(3.05, 10))
+            fetched = _parse_exchange_rates(response)
+            for query in missing:
+                rates[query] = fetched[query[2]]
+        except Exception as error:
+            _lookup_failed(error)
+        # saves all new rates with a single write
+        _save_rates({"|".join(query): rates[query] for query in missing})
+    return {year: rates[(country_name, currency_name, year)] for year in years}
+
+
+# Get exchange rate from Treasury website API
+# results are kept in memory and in CACHE_FILE, so the API is only called once per (country, currency, year)
+@functools.lru_cache(maxsize=256)
+def get_exchange_rate(country_name, currency_name, year):
+    return get_exchange_rates(country_name, currency_name, [year])[year]
+
+
+# groups queries of (country_name, currency_name, year) into a dict from (country_name, currency_name) to years
+def _group_queries(queries):
+    groups = {}
+    for country_name, currency_name, year in queries:
+        years = groups.setdefault((country_name, currency_name), [])
+        if year not in years:
+            years.append(year)
+    return groups
+
+
+# gets several exchange rates at the same time
+# queries is a list of (country_name, currency_name, year)
+# returns a dict from each query to its exchange rate
+def get_exchange_rates_bulk(queries):
+    # all years of the same country and currency go in one call, and calls for
+    # different countries are network bound, so threads can wait for Treasury in parallel
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = {group: executor.submit(get_exchange_rates, *group, years) for group, years in _group_queries(queries).items()}
+    rates = {group: future.result() for group, future in futures.items()}
+    return {query: rates[query[:2]][query[2]] for query in queries}
+
+
+# same as get_exchange_rates_bulk, but with asyncio and httpx instead of threads and requests
+# over HTTP/2 all lookups share one connection to Treasury
+# httpx is optional and only needed by this function: pip install "httpx[http2]"
+async def get_exchange_rates_async(queries):
+    # tries the cache file before going to the network
+    rates, missing = _split_cached(queries)
+    if missing:
+        import asyncio
+        import httpx
+
+        groups = _group_queries(missing)
+        # built outside the try, so a missing httpx or h2 raises ImportError instead of exiting
+        client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=1),
+            headers={"Accept": "text/csv, application/json", "Accept-Encoding": "gzip, deflate"},
+            timeout=httpx.Timeout(10, connect=3.05),
+        )
+        async with client:
+            try:
+                responses = await asyncio.gather(*[client.get(API_URL, params=_rate_params(*group, years)) for group, years in groups.items()])
+                for (group, years), response in zip(groups.items(), responses):
+                    fetched = _parse_exchange_rates(response)
+                    for year in years:
+                        rates[(*group, year)] = fetched[year]
+            except Exception as error:
+                _lookup_failed(error)
+        # saves all new rates with a single write
+        _save_rates({"|".join(query): rates[query] for query in missing})
+    return {query: rates[query] for query in queries}
 
 
 # calculates total balance in US dollars
@@ -45,7 +282,86 @@ def calculate_total_balance_in_USD(total_balance, exchange_rate):
         return 0
 
 
+# stops the program when the exchange rate cannot be used to convert balances
+def _validate_rate(exchange_rate):
+    if exchange_rate <= 0:
+        print("\nTreasury returned an invalid exchange rate, please check input values and try again")
+        sys.exit(1)
+
+
+# kernel for arrays of foreign balances, built by _kernels on first use
+_KERNELS = None
+
+
+# returns convert_vec, the kernel that divides an array of balances by the rate,
+# with negative balances counting as zero
+# numba compiles it to machine code when it is installed, but importing numba and
+# compiling take a while, so it only happens when a report needs it, never on import fbar
+# sums are not here on purpose: they use fsum, which is exact near FBAR_THRESHOLD
+def _kernels():
+    global _KERNELS
+    if _KERNELS is None:
+        import numpy as np
+
+        try:
+            from numba import njit
+        except ImportError:
+            njit = None
+
+        if njit is not None:
+            # cache keeps the compiled code in __pycache__ between runs
+            @njit(cache=True)
+            def convert_vec(foreign, exchange_rate):
+                usd = np.empty_like(foreign)
+                for i in range(foreign.shape[0]):
+                    usd[i] = max(foreign[i] / exchange_rate, 0.0)
+                return usd
+
+            # compiles (or loads from the cache) the kernel now, with a tiny array
+            convert_vec(np.zeros(1), 1.0)
+        else:
+            def convert_vec(foreign, exchange_rate):
+                usd = foreign / exchange_rate
+                # clamped in place without a second array
+                return np.maximum(usd, 0.0, out=usd)
+
+        _KERNELS = convert_vec
+    return _KERNELS
+
+
+# converts an array of foreign balances into US dollars
+# exchange_rate must already be checked with _validate_rate
+def _convert(foreign, exchange_rate):
+    return _kernels()(foreign, float(exchange_rate))
+
+
+# all banks of one report, one list or array per column instead of one list per bank
+#  year: tax return year, the same for every bank
+#  names: bank names
+#  foreign: foreign balances
+#  usd: balances in US dollars
+@dataclass
+class BankBook:
+    year: str
+    names: List[str]
+    foreign: np.ndarray
+    usd: np.ndarray
+
+    def __len__(self):
+        return len(self.names)
+
+
+# turns a BankBook into the old bank_data list, one (year, bank name, foreign, usd) per bank
+def _to_tuples(book):
+    return [(book.year, name, foreign, usd) for name, foreign, usd in zip(book.names, book.foreign.tolist(), book.usd.tolist())]
+
+
+# gets index 2 (foreign balance) of a bank_data item
+_get_bal = itemgetter(2)
+
+
 # sums all values in foreign currency
+# bank_data is a BankBook or a list like this:
 # bank_data = []
 #  0: year
 #  1: bank name
@@ -53,93 +369,174 @@ def calculate_total_balance_in_USD(total_balance, exchange_rate):
 #  3: USD balance
 def get_total_foreign_balance(bank_data):
     try:
-        result = 0
-        # for each item inside the list...
-        for item in bank_data:
-            # gets index 2 of the list and adds it to result
-            result += item[2]
-        return result
+        # fsum adds without rounding errors, so many cents never move the total across FBAR_THRESHOLD
+        # a BankBook already has its balances in one array, the old list has them at index 2
+        if isinstance(bank_data, BankBook):
+            return fsum(bank_data.foreign)
+        return fsum(map(_get_bal, bank_data))
     except:
         # if anything goes wrong returns 0
         return 0
 
 
-# generic function to validate inputs based on patterns
-def validate_input(value, pattern):
-    if not re.match(pattern, value):
+# asks the user for each bank name and balance
+# returns the list of names and the array of balances
+def _ask_bank_data(year, currency_symbol):
+    # each column is kept in its own list while the user types
+    names = []
+    balances = array('d')
+    # loop to request all bank names and balances
+    while True:
+        # asks user for a bank name
+        bank_name = input("Enter bank name (leave blank to finish): ")
+        if not bank_name:
+            break
+        # bank name cannot be empty
+        validate_input(bank_name, bool)
+        # asks user for the balance 
+        balance = input(f"- Enter highest balance on {year} in {currency_symbol} for {bank_name}: ")
+        # balance can only be number(s)
+        validate_input(balance, str.isdecimal)
+        # converts balance into float
+        balance = float(balance)
+        # repeated bank names share one string
+        names.append(sys.intern(bank_name))
+        balances.append(balance)
+    return names, balances
+
+
+# reads bank names and balances from lines already read from a file or a pipe
+# lines alternate between bank name and balance
+# returns the list of names and the array of balances
+def _read_bank_data(lines):
+    # a blank bank name ends the list, like in the interactive loop
+    if "" in lines[::2]:
+        lines = lines[:lines[::2].index("") * 2]
+    # a bank name in the last line has no balance, padded on a copy so the caller's list is kept
+    if len(lines) % 2:
+        lines = lines + [""]
+    # repeated bank names share one string
+    names = [sys.intern(bank_name) for bank_name in lines[0::2]]
+    # balance can only be number(s), all of them are checked before any is converted
+    for balance in lines[1::2]:
+        validate_input(balance, str.isdecimal)
+    balances = array('d', (float(balance) for balance in lines[1::2]))
+    return names, balances
+
+
+# asks the user for all bank names and balances
+# returns a BankBook
+def get_bank_data(year, currency_symbol, usd_rate):
+    # checks the rate once, instead of once for every bank
+    _validate_rate(usd_rate)
+    # every row shares the same year string
+    year = sys.intern(year)
+    # when stdin is a file or a pipe (python fbar.py < accounts.txt) all lines are read at once
+    if sys.stdin.isatty():
+        names, balances = _ask_bank_data(year, currency_symbol)
+    else:
+        names, balances = _read_bank_data(sys.stdin.read().splitlines())
+
+    # numpy is only loaded when there are balances to work with
+    import numpy as np
+
+    # uses the typed balances as a numpy array without copying them
+    foreign = np.frombuffer(balances, dtype=np.float64)
+    # converts all balances into US dollar with a single division
+    return BankBook(year, names, foreign, _convert(foreign, usd_rate))
+
+
+# generic function to validate inputs
+# check can be a compiled pattern or any function that returns True for good values
+def validate_input(value, check):
+    if isinstance(check, re.Pattern):
+        check = check.match
+    if not check(value):
         print("Value not acceptable")
         sys.exit(1)
 
 
+# prints the table of banks in a grid
+# rows and headers are strings already formatted, column 1 (bank name) is aligned left and all others right
+def _print_grid(rows, headers):
+    # each column is as wide as its longest text, and headers get 2 extra spaces like tabulate's grid did
+    widths = [max(len(header) + 2, *(len(row[i]) for row in rows)) for i, header in enumerate(headers)]
+
+    # builds one line of the table, like | 2022 | Itau | ... |
+    def line(cells):
+        return "| " + " | ".join(cell.ljust(width) if i == 1 else cell.rjust(width) for i, (cell, width) in enumerate(zip(cells, widths))) + " |"
+
+    # borders between lines, the header one is made of = instead of -
+    border = "+" + "+".join("-" * (width + 2) for width in widths) + "+"
+    header_border = "+" + "+".join("=" * (width + 2) for width in widths) + "+"
+
+    print(border)
+    print(line(headers))
+    print(header_border)
+    for row in rows:
+        print(line(row))
+        print(border)
+
+
+# prints the exchange rate, the table of banks and if an FBAR form may be needed
+def display_results(book, year, currency_name, currency_symbol, usd_rate, total_foreign_balance, total_balance_in_USD):
+    # prints summary of user input without values
+    print(f"\nDolar to {currency_name} Treasury reference for {year} is {currency_symbol}{usd_rate}")
+    print()
+    # bank data needs to have more than one entry to...
+    if len(book) > 0:
+        # define the table header and...
+        header = ['Year', 'Bank Name', 'Currency in ' + currency_symbol, 'Currency in US$']
+        # formats the balances as text with 2 decimals
+        rows = [(row_year, name, f"{foreign:.2f}", f"{usd:.2f}") for row_year, name, foreign, usd in _to_tuples(book)]
+        # prints the table
+        _print_grid(rows, header)
+        print()
+    print(f"Total balance of {currency_symbol}{total_foreign_balance:.2f} on {year} was equivalent to US${total_balance_in_USD:.2f}")
+    # picks the message by using the comparison (False or True) as index 0 or 1
+    message = _FBAR_MESSAGES[total_balance_in_USD >= FBAR_THRESHOLD]
+    print(message.format(threshold=_THRESHOLD_STR, next_year=int(year) + 1))
+
+
 # calculates fbar from user input
 def main():
     print("-----------------------------")
     print("FBAR Calculator")
     print("-----------------------------")
     print()
+    # gets the array kernels ready while nothing has been asked yet
+    _kernels()
 
     # gets year from user
     year = input("Tax Return Year (like 2021): ") or "2021"
     # only accepts four-digits year
-    validate_input(year,r"^\d\d\d\d$")
+    validate_input(year, _YEAR_RE)
     # gets name of the country from user
     country_name = input("Country of where your assets are (like Brazil): ") or "Brazil"
     # at least one letter or digit
-    validate_input(country_name,r".+")
+    validate_input(country_name, bool)
     # gets name of currency from user
     currency_name = input(f"Currency Name for {country_name} (like Real): ") or "Real"
     # at least one letter or digit
-    validate_input(currency_name,r".+")
+    validate_input(currency_name, bool)
     # gets symbol of currency from user
     currency_symbol = input("Currency Symbol for that country (like R$): ") or "R$"
     # validates if symbol has 1 letter at least
-    validate_input(currency_symbol,r".+")
+    validate_input(currency_symbol, bool)
 
     # gets dollar value for requested parameters (Dec 31st for the year)
     usd_rate = get_exchange_rate(country_name, currency_name, year)
 
     # ask for bank names and balances
-    bank_data = []
     print()
-    # loop to request all bank names and balances
-    while True:
-        # asks user for a bank name
-        bank_name = input("Enter bank name (leave blank to finish): ")
-        if not bank_name:
-            break
-        # bank name cannot be empty
-        validate_input(bank_name,r".+")
-        # asks user for the balance 
-        balance = input(f"- Enter highest balance on {year} in {currency_symbol} for {bank_name}: ")
-        # balance can only be number(s)
-        validate_input(balance,r"^[0-9]+$")
-        # converts balance into float
-        balance = float(balance)
-        # puts every input inside an "item", then inside a list
-        bank_data.append([year, bank_name, balance, calculate_total_balance_in_USD(balance, usd_rate)])
+    book = get_bank_data(year, currency_symbol, usd_rate)
 
     # extracts total foreing balance from bank data
-    total_foreign_balance = get_total_foreign_balance(bank_data)
+    total_foreign_balance = get_total_foreign_balance(book)
     # converts foreign balance into US dollar
     total_balance_in_USD = calculate_total_balance_in_USD(total_foreign_balance, usd_rate)
-    # prints summary of user input without values
-    print(f"\nDolar to {currency_name} Treasury reference for {year} is {currency_symbol}{usd_rate}")
-    print()
-    # bank data needs to have more than one entry to...
-    if len(bank_data) > 0:
-        # define the table header and...
-        header = ['Year', 'Bank Name', 'Currency in ' + currency_symbol, 'Currency in US$']
-        # prints the table
-        print(tabulate.tabulate(bank_data, header, tablefmt="grid", floatfmt=".2f"))
-        print()
-    print(f"Total balance of {currency_symbol}{total_foreign_balance:.2f} on {year} was equivalent to US${total_balance_in_USD:.2f}")
-    if total_balance_in_USD >= 10000:
-        # prints a message (fbar needed) since total balance is >= 10000
-        print(f"As it exceeds US$10,000 you MAY NEED to file an FBAR form on April of {int(year)+1}.")
-        print("Please go to https://bsaefiling.fincen.treas.gov/NoRegFBARFiler.html and type all asset values there for online FBAR filing.")
-    else:
-        # prints a message (fbar NOT needed) since total balance is < 10000
-        print(f"As it does not exceed US$10,000 you may not need to file a FBAR form on April of {int(year)+1}.")
+    # prints the report
+    display_results(book, year, currency_name, currency_symbol, usd_rate, total_foreign_balance, total_balance_in_USD)
 
 
 if __name__ == "__main__":
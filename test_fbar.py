@@ -1,9 +1,34 @@
 # test_project.py
 # Carolina Lovato
 
+import asyncio
+import datetime
+import io
+import json
+import sys
+import time
+import numpy as np
+import pytest
+import fbar
 from fbar import get_exchange_rate
+from fbar import get_exchange_rates
+from fbar import get_exchange_rates_bulk
+from fbar import get_exchange_rates_async
 from fbar import calculate_total_balance_in_USD
 from fbar import get_total_foreign_balance
+from fbar import BankBook
+from fbar import validate_input
+from fbar import display_results
+
+
+# every test gets its own empty cache file and an empty get_exchange_rate memory,
+# so rate lookups really go to Treasury (or to the fake one) and never touch the home directory
+@pytest.fixture(autouse=True)
+def empty_rate_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(fbar, "CACHE_FILE", str(tmp_path / "rates.json"))
+    get_exchange_rate.cache_clear()
+    yield
+    get_exchange_rate.cache_clear()
 
 
 # test get_exchange_rate
@@ -14,6 +39,132 @@ def test_get_exchange_rate():
     assert get_exchange_rate('Canada', 'Dollar', '2021') == 1.277
 
 
+# stands in for a requests or httpx response, only .text and .content are used
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.content = text.encode()
+
+
+# stands in for the shared requests session, always answers with the same text
+class FakeSession:
+    def __init__(self, text):
+        self.text = text
+        self.calls = []
+
+    def get(self, url, params=None, timeout=None):
+        self.calls.append(params)
+        return FakeResponse(self.text)
+
+
+# test _parse_exchange_rates with csv and json answers
+def test_parse_exchange_rates():
+    plain = FakeResponse("exchange_rate,record_date\n5.668,2021-12-31\n1.85,2011-12-31\n")
+    assert fbar._parse_exchange_rates(plain) == {"2021": 5.668, "2011": 1.85}
+    quoted = FakeResponse('"exchange_rate","record_date"\r\n"5.668","2021-12-31"\r\n')
+    assert fbar._parse_exchange_rates(quoted) == {"2021": 5.668}
+    json_answer = FakeResponse('{"data": [{"exchange_rate": "1.277", "record_date": "2021-12-31"}]}')
+    assert fbar._parse_exchange_rates(json_answer) == {"2021": 1.277}
+    assert fbar._parse_exchange_rates(FakeResponse('"exchange_rate","record_date"\r\n')) == {}
+
+
+# test get_exchange_rates with a fake Treasury: all years go in one call and come back as {year: rate}
+def test_get_exchange_rates_one_call(monkeypatch):
+    session = FakeSession('"exchange_rate","record_date"\r\n"5.286","2022-12-31"\r\n"5.668","2021-12-31"\r\n"1.85","2011-12-31"\r\n')
+    monkeypatch.setattr(fbar, "_get_session", lambda: session)
+    assert get_exchange_rates('Brazil', 'Real', ['2021', '2011', '2022']) == {'2021': 5.668, '2011': 1.85, '2022': 5.286}
+    assert session.calls == [{
+        "format": "csv",
+        "fields": "exchange_rate,record_date",
+        "sort": "-record_date",
+        "page[size]": 3,
+        "filter": "country_currency_desc:eq:Brazil-Real,record_date:in:(2021-12-31,2011-12-31,2022-12-31)",
+    }]
+    # the second time everything comes from the cache file
+    assert get_exchange_rates('Brazil', 'Real', ['2011', '2021']) == {'2011': 1.85, '2021': 5.668}
+    assert len(session.calls) == 1
+
+
+# test get_exchange_rates_bulk with a fake Treasury: one call per country and currency
+def test_get_exchange_rates_bulk_grouped(monkeypatch):
+    session = FakeSession('"exchange_rate","record_date"\r\n"5.668","2021-12-31"\r\n"1.85","2011-12-31"\r\n')
+    monkeypatch.setattr(fbar, "_get_session", lambda: session)
+    rates = get_exchange_rates_bulk([('Brazil', 'Real', '2021'), ('Brazil', 'Real', '2011'), ('Brazil', 'Real', '2021')])
+    assert rates == {('Brazil', 'Real', '2021'): 5.668, ('Brazil', 'Real', '2011'): 1.85}
+    assert [params["filter"] for params in session.calls] == ["country_currency_desc:eq:Brazil-Real,record_date:in:(2021-12-31,2011-12-31)"]
+
+
+# test get_exchange_rates when Treasury has no data for the year
+def test_get_exchange_rates_no_data(monkeypatch, capsys):
+    monkeypatch.setattr(fbar, "_get_session", lambda: FakeSession('"exchange_rate","record_date"\r\n'))
+    with pytest.raises(SystemExit):
+        get_exchange_rates('Brazil', 'Real', ['1900'])
+    assert "returned no data" in capsys.readouterr().out
+
+
+# test get_exchange_rates_async with a fake Treasury, one call per country and currency
+def test_get_exchange_rates_async(monkeypatch):
+    httpx = pytest.importorskip("httpx")
+    answers = {
+        "Brazil-Real": '"exchange_rate","record_date"\r\n"5.668","2021-12-31"\r\n"1.85","2011-12-31"\r\n',
+        "Canada-Dollar": '"exchange_rate","record_date"\r\n"1.277","2021-12-31"\r\n',
+    }
+    filters = []
+
+    def treasury(request):
+        filters.append(request.url.params["filter"])
+        country_currency = request.url.params["filter"].split(",")[0].split(":")[-1]
+        return httpx.Response(200, text=answers[country_currency])
+
+    # every client made by fbar answers through the fake Treasury
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(httpx, "AsyncClient", lambda **kwargs: real_client(transport=httpx.MockTransport(treasury), **kwargs))
+    queries = [('Brazil', 'Real', '2021'), ('Brazil', 'Real', '2011'), ('Canada', 'Dollar', '2021')]
+    rates = asyncio.run(get_exchange_rates_async(queries))
+    assert rates == {
+        ('Brazil', 'Real', '2021'): 5.668,
+        ('Brazil', 'Real', '2011'): 1.85,
+        ('Canada', 'Dollar', '2021'): 1.277,
+    }
+    assert sorted(filters) == [
+        "country_currency_desc:eq:Brazil-Real,record_date:in:(2021-12-31,2011-12-31)",
+        "country_currency_desc:eq:Canada-Dollar,record_date:in:(2021-12-31)",
+    ]
+    # the second time everything comes from the cache file
+    assert asyncio.run(get_exchange_rates_async(queries)) == rates
+    assert len(filters) == 2
+
+
+# test the cache file: past years never expire, the current year expires after CURRENT_YEAR_TTL
+def test_cached_rate_ttl():
+    this_year = str(datetime.datetime.now().year)
+    long_ago = time.time() - 10 * fbar.CURRENT_YEAR_TTL
+    with open(fbar.CACHE_FILE, "w") as file:
+        json.dump({
+            "Brazil|Real|2011": {"rate": 1.85, "fetched": long_ago},
+            f"Brazil|Real|{this_year}": {"rate": 5.0, "fetched": long_ago},
+            f"Canada|Dollar|{this_year}": {"rate": 1.3, "fetched": time.time()},
+        }, file)
+    cache = fbar._load_cache()
+    assert fbar._cached_rate(cache, "Brazil|Real|2011", "2011") == 1.85
+    assert fbar._cached_rate(cache, f"Brazil|Real|{this_year}", this_year) is None
+    assert fbar._cached_rate(cache, f"Canada|Dollar|{this_year}", this_year) == 1.3
+    assert fbar._cached_rate(cache, "Peru|Sol|2011", "2011") is None
+
+
+# test writing many rates to the cache file at once
+def test_save_rates(tmp_path, monkeypatch):
+    monkeypatch.setattr(fbar, "CACHE_FILE", str(tmp_path / "fbar" / "rates.json"))
+    fbar._save_rates({"Brazil|Real|2011": 1.85})
+    fbar._save_rates({"Brazil|Real|2021": 5.668, "Canada|Dollar|2021": 1.277})
+    cache = fbar._load_cache()
+    assert {key: entry["rate"] for key, entry in cache.items()} == {
+        "Brazil|Real|2011": 1.85,
+        "Brazil|Real|2021": 5.668,
+        "Canada|Dollar|2021": 1.277,
+    }
+
+
 # test calculate_total_balance_in_USD
 def test_calculate_total_balance_in_USD():
     assert calculate_total_balance_in_USD(10,5) == 2
@@ -33,6 +184,15 @@ def test_get_total_foreign_balance():
     assert get_total_foreign_balance(bank_data) == 600
 
 
+# test get_total_foreign_balance with a BankBook
+def test_get_total_foreign_balance_book():
+    book = BankBook("2010", ["Itau1", "Itau2", "Itau3"], np.array([100.0, 200.0, 300.0]), np.array([50.0, 60.0, 70.0]))
+    assert get_total_foreign_balance(book) == 600
+    # the sum is exact, ten times 0.1 is 1 and not 0.9999999999999999
+    cents = BankBook("2010", ["Itau"] * 10, np.array([0.1] * 10), np.zeros(10))
+    assert get_total_foreign_balance(cents) == 1
+
+
 # test get_total_foreign_balance for errors
 def test_get_total_foreign_balance_fail():
     # INVALID bank_data structure
@@ -41,4 +201,110 @@ def test_get_total_foreign_balance_fail():
         ["2010", "Itau2", "horse", 60],
         ["2010", "Itau3", "300", 70],
     ]
-    assert get_total_foreign_balance(bank_data) == 0
\ No newline at end of file
+    assert get_total_foreign_balance(bank_data) == 0
+
+
+# test _read_bank_data: a blank bank name ends the list
+def test_read_bank_data():
+    names, balances = fbar._read_bank_data(["Itau", "100", "Bradesco", "200", "", "ignored", "x"])
+    assert names == ["Itau", "Bradesco"]
+    assert list(balances) == [100.0, 200.0]
+
+
+# test _read_bank_data with no lines at all
+def test_read_bank_data_empty():
+    names, balances = fbar._read_bank_data([])
+    assert names == []
+    assert list(balances) == []
+
+
+# test _read_bank_data when the last bank has no balance
+def test_read_bank_data_missing_balance():
+    lines = ["Itau", "100", "Bradesco"]
+    with pytest.raises(SystemExit):
+        fbar._read_bank_data(lines)
+    # the caller's lines are not changed
+    assert lines == ["Itau", "100", "Bradesco"]
+
+
+# test _read_bank_data with a balance that is not a number
+def test_read_bank_data_bad_balance():
+    with pytest.raises(SystemExit):
+        fbar._read_bank_data(["Itau", "100", "Bradesco", "3x0"])
+
+
+# test validate_input with a compiled pattern and with predicates
+def test_validate_input():
+    validate_input("2021", fbar._YEAR_RE)
+    validate_input("Itau", bool)
+    validate_input("100", str.isdecimal)
+    for value, check in [("21", fbar._YEAR_RE), ("2021\n", fbar._YEAR_RE), ("", bool), ("3x0", str.isdecimal), ("²", str.isdecimal)]:
+        with pytest.raises(SystemExit):
+            validate_input(value, check)
+
+
+# test _validate_rate: a rate of 0 or below stops the program
+def test_validate_rate():
+    fbar._validate_rate(5.286)
+    for rate in (0, -1):
+        with pytest.raises(SystemExit):
+            fbar._validate_rate(rate)
+
+
+# test _convert with the installed kernel and with the numpy one, which must give the same numbers
+@pytest.mark.parametrize("without_numba", [False, True])
+def test_convert(monkeypatch, without_numba):
+    if without_numba:
+        # makes _kernels build the numpy kernel again, as if numba was not installed
+        monkeypatch.setitem(sys.modules, "numba", None)
+    monkeypatch.setattr(fbar, "_KERNELS", None)
+    usd = fbar._convert(np.array([10000.0, -100.0, 0.0, 30000.0]), 5.0)
+    assert usd.tolist() == [2000.0, 0.0, 0.0, 6000.0]
+
+
+# test display_results exactly at FBAR_THRESHOLD and just below it
+def test_display_results_threshold(capsys):
+    book = BankBook("2022", [], np.array([]), np.array([]))
+    display_results(book, "2022", "Real", "R$", 5.0, 50000.0, fbar.FBAR_THRESHOLD)
+    out = capsys.readouterr().out
+    assert "As it exceeds US$10,000 you MAY NEED to file an FBAR form on April of 2023." in out
+    assert "NoRegFBARFiler" in out
+    display_results(book, "2022", "Real", "R$", 5.0, 49999.95, fbar.FBAR_THRESHOLD - 0.01)
+    out = capsys.readouterr().out
+    assert "As it does not exceed US$10,000 you may not need to file a FBAR form on April of 2023." in out
+    assert "MAY NEED" not in out
+
+
+# test display_results prints the same grid as the README example
+# "Banco do Brasil" is wider than its header, so that column is sized by the bank name
+def test_display_results_grid(capsys):
+    foreign = np.array([10000.0, 30000.0, 50000.0])
+    book = BankBook("2022", ["Itau", "Bradesco", "Banco do Brasil"], foreign, foreign / 5.286)
+    display_results(book, "2022", "Real", "R$", 5.286, 90000.0, 90000.0 / 5.286)
+    assert capsys.readouterr().out.startswith(
+        "\nDolar to Real Treasury reference for 2022 is R$5.286\n"
+        "\n"
+        "+--------+-----------------+------------------+-------------------+\n"
+        "|   Year | Bank Name       |   Currency in R$ |   Currency in US$ |\n"
+        "+========+=================+==================+===================+\n"
+        "|   2022 | Itau            |         10000.00 |           1891.79 |\n"
+        "+--------+-----------------+------------------+-------------------+\n"
+        "|   2022 | Bradesco        |         30000.00 |           5675.37 |\n"
+        "+--------+-----------------+------------------+-------------------+\n"
+        "|   2022 | Banco do Brasil |         50000.00 |           9458.95 |\n"
+        "+--------+-----------------+------------------+-------------------+\n"
+        "\n"
+        "Total balance of R$90000.00 on 2022 was equivalent to US$17026.11\n"
+    )
+
+
+# test get_bank_data reading from a file or pipe, and _to_tuples turning its BankBook back into rows
+def test_get_bank_data(monkeypatch):
+    monkeypatch.setattr(sys, "stdin", io.StringIO("Itau\n100\nBradesco\n200\n"))
+    book = fbar.get_bank_data("2010", "R$", 4.0)
+    assert isinstance(book, BankBook)
+    assert book.year == "2010"
+    assert book.names == ["Itau", "Bradesco"]
+    assert book.foreign.tolist() == [100.0, 200.0]
+    assert book.usd.tolist() == [25.0, 50.0]
+    assert fbar._to_tuples(book) == [("2010", "Itau", 100.0, 25.0), ("2010", "Bradesco", 200.0, 50.0)]